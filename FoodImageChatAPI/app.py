@@ -1,13 +1,27 @@
 ﻿import os
 import base64
-import json
+import logging
 from fastapi import FastAPI, File, UploadFile, Form
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 
 import chat_client
+import food_index
+import json_codec
+import result_cache
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded through json_codec (orjson when installed)."""
+
+    def render(self, content) -> bytes:
+        return json_codec.dumps(content)
+
+
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Allow SPA (Vite dev server) to call this API from browser
 origins = [
@@ -22,11 +36,42 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+def _without_usage(obj):
+    """Copy of a response body minus token usage, so cache hits don't report tokens they didn't spend."""
+    if isinstance(obj, dict):
+        return {k: _without_usage(v) for k, v in obj.items() if k != "usage"}
+    if isinstance(obj, list):
+        return [_without_usage(v) for v in obj]
+    return obj
+
+
+@app.on_event("startup")
+async def load_food_index():
+    # memory-map the food embedding index (if built) before the first request
+    try:
+        food_index.get_index()
+    except Exception as e:
+        logger.warning("food index not loaded: %s", e)
+
+
 @app.get('/health')
 async def health():
     return {"status": "ok"}
 
 
+@app.get('/stats')
+async def stats():
+    # hedge rate, wins per model and circuit breaker state (USE_HEDGING=1),
+    # token usage / estimated cost per mode and model
+    body = {
+        "routing": chat_client.get_routing_stats(),
+        "usage": chat_client.get_usage_stats(),
+    }
+    if result_cache.enabled():
+        body["result_cache"] = await run_in_threadpool(result_cache.stats)
+    return body
+
+
 @app.get('/', response_class=HTMLResponse)
 async def homepage():
     html = """<!doctype html>
@@ -39,6 +84,7 @@ async def homepage():
         <select name="mode">
           <option value="chat">Chat API (default)</option>
           <option value="local">Local model (fallback)</option>
+          <option value="multi">Multi-item plate (local, batched)</option>
         </select>
         <button type="submit">Classify</button>
       </form>
@@ -52,40 +98,102 @@ async def classify(image: UploadFile = File(...), mode: str = Form(None)):
     content = await image.read()
     b64 = base64.b64encode(content).decode('utf-8')
     chosen_mode = (mode or os.getenv('MODE', 'chat')).lower()
+
+    # Shared (cross-worker) result cache, enabled via USE_RESULT_CACHE=1
+    cache_key = None
+    if result_cache.enabled():
+        cache_key = result_cache.make_key(
+            content,
+            chosen_mode,
+            os.getenv("CHAT_MODEL", ""),
+            os.getenv("OUTPUT_LANG", "en"),
+            os.getenv("USE_REASONING", "0"),
+            os.getenv("MULTI_ESCALATE", "0"),
+            os.getenv("CHAT_MODEL_FALLBACK", ""),
+            os.getenv("USE_HEDGING", "0"),
+            food_index.index_fingerprint(),
+            os.getenv("IMAGE_DETAIL", "auto"),
+            # local / multi mode settings
+            os.getenv("FOOD_INDEX_TOP_K", "3"),
+            os.getenv("FOOD_INDEX_PROBE", "0"),
+            os.getenv("FOOD_MULTI_GRIDS", "2,3"),
+            os.getenv("FOOD_MULTI_MIN_SCORE", ""),
+            os.getenv("FOOD_MULTI_AMBIGUOUS_BELOW", ""),
+            os.getenv("FOOD_MULTI_MIN_MARGIN", "0.03"),
+        )
+        # SQLite I/O (busy timeout, periodic prune) stays off the event loop
+        cached = await run_in_threadpool(result_cache.get, cache_key)
+        if cached is not None:
+            cached["cached"] = True
+            return FastJSONResponse(cached)
+
+    if chosen_mode == 'multi':
+        try:
+            from local_model_fixed import local_multi_inference, crops_jpeg_base64
+
+            res = await run_in_threadpool(local_multi_inference, content)
+            if "error" in res:
+                return FastJSONResponse({"error": "local model not available", "detail": res["error"]}, status_code=500)
+
+            # Optionally send only the ambiguous crops to the chat model, all in one request
+            ambiguous = [it for it in res["items"] if it["ambiguous"]]
+            if ambiguous and os.getenv("MULTI_ESCALATE", "0") == "1":
+                try:
+                    crops = crops_jpeg_base64(content, [it["box"] for it in ambiguous])
+                    answers = await run_in_threadpool(chat_client.classify_crops_base64, crops)
+                    for it, ans in zip(ambiguous, answers):
+                        if ans and ans.get("label") != "unknown":
+                            it.update(ans, source="chat", ambiguous=False)
+                    res["total_calories_kcal"] = sum(float(it.get("calories_kcal") or 0) for it in res["items"])
+                except Exception as e:
+                    res["escalation_error"] = str(e)
+
+            lines = [f"음식 {len(res['items'])}개 (총 {int(round(res['total_calories_kcal']))} kcal)"]
+            for it in res["items"]:
+                kcal = it.get("calories_kcal")
+                kcal_text = f"{int(round(float(kcal)))} kcal" if kcal is not None else "알 수 없음"
+                lines.append(f"- {it.get('label_ko') or it['label']} : {kcal_text} ({it.get('serving_ko') or it.get('serving', '-')})")
+            body = {"text": "\n".join(lines), "data": res}
+            if cache_key:
+                await run_in_threadpool(result_cache.put, cache_key, _without_usage(body))
+            return FastJSONResponse(body)
+        except Exception as e:
+            return FastJSONResponse({"error": "multi-item classify failed", "detail": str(e)}, status_code=500)
+
     if chosen_mode == 'local':
         try:
             # import the fixed local model implementation
             from local_model_fixed import local_inference
 
-            res = local_inference(content)
-            return JSONResponse(res)
+            res = await run_in_threadpool(local_inference, content)
+            if cache_key and "error" not in res:
+                await run_in_threadpool(result_cache.put, cache_key, _without_usage(res))
+            return FastJSONResponse(res)
         except Exception as e:
-            return JSONResponse({"error": "local model not available", "detail": str(e)}, status_code=500)
+            return FastJSONResponse({"error": "local model not available", "detail": str(e)}, status_code=500)
 
     try:
         # Two-pass reasoning fallback if enabled via env USE_REASONING=1
         use_reasoning = os.getenv("USE_REASONING", "0") == "1"
+        # Hedged primary/fallback calls + circuit breaker if USE_HEDGING=1
+        use_hedging = os.getenv("USE_HEDGING", "0") == "1"
         if use_reasoning:
             result = chat_client.classify_image_base64_reasoned(b64)
+        elif use_hedging:
+            result = await run_in_threadpool(chat_client.classify_image_base64_hedged, b64)
         else:
             result = chat_client.classify_image_base64(b64)
 
-        # If the client returned a raw string, try to parse JSON out of it
+        # If the client returned a raw string, extract + validate the JSON object once
         parsed = None
         if isinstance(result, str):
-            try:
-                parsed = json.loads(result)
-            except Exception:
-                # try to extract JSON block
-                from chat_client import _safe_json_parse
-
-                parsed = _safe_json_parse(result)
+            parsed = json_codec.parse_result(result)
         elif isinstance(result, dict):
             parsed = result
 
         if not parsed:
             # couldn't parse JSON, return raw
-            return JSONResponse({"raw": result})
+            return FastJSONResponse({"raw": result})
 
         # Format a human-friendly Korean text response (prefer *_ko fields if present)
         label = parsed.get("label_ko") or parsed.get("label", "알 수 없음")
@@ -119,6 +227,10 @@ async def classify(image: UploadFile = File(...), mode: str = Form(None)):
             f"메모 : {notes}"
         )
 
-        return JSONResponse({"text": text, "data": parsed})
+        body = {"text": text, "data": parsed}
+        # don't cache degraded answers served by the circuit breaker
+        if cache_key and parsed.get("routed_to") != "local":
+            await run_in_threadpool(result_cache.put, cache_key, _without_usage(body))
+        return FastJSONResponse(body)
     except Exception as e:
-        return JSONResponse({"error": "chat classify failed", "detail": str(e)}, status_code=500)
+        return FastJSONResponse({"error": "chat classify failed", "detail": str(e)}, status_code=500)
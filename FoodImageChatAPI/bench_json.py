@@ -0,0 +1,79 @@
+"""Micro-benchmarks for json_codec on representative model outputs.
+
+    python bench_json.py [--number 20000]
+
+Compares the previous chat_client._safe_json_parse logic (json.loads, then
+find/rfind + json.loads) with json_codec.extract_json_object, and stdlib
+JSONResponse-style encoding with json_codec.dumps.
+"""
+import json
+import timeit
+import argparse
+
+import json_codec
+
+_RESULT = {
+    "label": "bibimbap",
+    "confidence": 0.87,
+    "calories_kcal": 560,
+    "serving": "1 bowl (~400 g)",
+    "notes": "Range 500-650 kcal depending on rice and gochujang; alternatives: fried rice, kimchi fried rice",
+    "label_ko": "비빔밥",
+    "serving_ko": "1그릇 (~400 g)",
+    "notes_ko": "밥 양과 고추장에 따라 500-650 kcal; 대안: 볶음밥, 김치볶음밥",
+}
+_JSON = json.dumps(_RESULT, ensure_ascii=False)
+
+SAMPLES = {
+    "clean": _JSON,
+    "fenced": "```json\n" + json.dumps(_RESULT, ensure_ascii=False, indent=2) + "\n```",
+    "prose": "Here is the result:\n" + _JSON + "\nLet me know if you need more details {or alternatives}.",
+    "braces_in_string": json.dumps(dict(_RESULT, notes="served with {side dishes}; \"banchan\" \\ extra"), ensure_ascii=False),
+}
+
+RESPONSE_BODY = {"text": "음식 이름 : 비빔밥 (신뢰도: 0.87)\n칼로리 (평균) : 560 kcal", "data": _RESULT}
+
+
+def _legacy_parse(text: str):
+    try:
+        return json.loads(text)
+    except Exception:
+        pass
+    start = text.find("{")
+    end = text.rfind("}")
+    if start != -1 and end != -1 and end > start:
+        try:
+            return json.loads(text[start:end + 1])
+        except Exception:
+            pass
+    return None
+
+
+def _stdlib_render(content) -> bytes:
+    # starlette JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def _us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--number", type=int, default=20000)
+    args = ap.parse_args()
+    print(f"backend: {json_codec.BACKEND}")
+    print(f"{'case':<18}{'legacy us':>11}{'codec us':>11}  legacy ok / codec ok")
+    for name, text in SAMPLES.items():
+        legacy = _us(lambda: _legacy_parse(text), args.number)
+        codec = _us(lambda: json_codec.extract_json_object(text), args.number)
+        ok_legacy = _legacy_parse(text) is not None
+        ok_codec = json_codec.extract_json_object(text) is not None
+        print(f"{name:<18}{legacy:>11.2f}{codec:>11.2f}  {ok_legacy} / {ok_codec}")
+    stdlib = _us(lambda: _stdlib_render(RESPONSE_BODY), args.number)
+    codec = _us(lambda: json_codec.dumps(RESPONSE_BODY), args.number)
+    print(f"{'encode response':<18}{stdlib:>11.2f}{codec:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
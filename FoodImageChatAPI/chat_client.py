@@ -1,7 +1,14 @@
 ﻿import os
 import json
+import time
+import base64
 import difflib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
+
+import json_codec
 try:
     from dotenv import load_dotenv  # type: ignore
     load_dotenv()
@@ -20,18 +27,10 @@ except Exception:
 
 
 def _safe_json_parse(text: str):
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    start = text.find("{")
-    end = text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        try:
-            return json.loads(text[start:end+1])
-        except Exception:
-            pass
-    return None
+    # kept for callers importing it; extraction lives in json_codec
+    return json_codec.extract_json_object(text)
+
+
 def _ascii_clean(s: str) -> str:
     try:
         return s.encode("ascii", "ignore").decode("ascii")
@@ -52,7 +51,184 @@ def _normalize_model(name: str | None) -> str | None:
     return aliases.get(n, n)
 
 
-def _responses_http_call(api_key: str, model: str, prompt_text: str, b64_image: str, include_schema: bool = True) -> str:
+# ---------------------------------------------------------------------------
+# Request layout
+#
+# Every call starts with the same system message (task description, JSON
+# schema, rules, allowed labels). It is built once per process and is
+# byte-identical across requests, languages and reasoning passes. Variable text
+# (language addendum, reasoning candidates, overrides) and the image follow in
+# the user message.
+# NOTE: OpenAI prompt caching only applies to prompts of >= 1024 tokens and
+# caches in 128-token steps from the start. This prefix is ~210 tokens, so on its
+# own it is NOT cached (cached_tokens stays 0); it only becomes cacheable if the
+# label list / instructions grow past that threshold. The layout is kept so that
+# growth is cached automatically, and usage accounting shows when that happens.
+# ---------------------------------------------------------------------------
+
+_LABELS_PATH = os.path.join(os.path.dirname(__file__), "food_labels.json")
+_static_cache: dict = {}
+
+
+def _load_allowed_labels() -> list:
+    try:
+        mtime = os.path.getmtime(_LABELS_PATH)
+    except OSError:
+        return []
+    cached = _static_cache.get("labels")
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(_LABELS_PATH, "r", encoding="utf-8") as f:
+            labels = json.load(f)
+    except Exception:
+        labels = []
+    _static_cache["labels"] = (mtime, labels)
+    _static_cache.pop("prefix", None)
+    return labels
+
+
+def _static_prefix() -> str:
+    """Stable system prompt shared by every chat call (cacheable prefix)."""
+    labels = _load_allowed_labels()
+    prefix = _static_cache.get("prefix")
+    if prefix is not None:
+        return prefix
+    # ASCII-only prompt (English) to avoid any encoding issues on some environments.
+    allowed_labels_ascii = [_ascii_clean(str(x)) for x in labels]
+    prefix = (
+        "You classify food photos and estimate calories.\n"
+        "JSON result schema (base):\n"
+        "{\n  \"label\": string,\n  \"confidence\": number,\n  \"calories_kcal\": number,\n  \"serving\": string,\n  \"notes\": string\n}\n"
+        "Rules:\n- label must be from the allowed list or 'unknown'\n- confidence is 0..1\n- calories_kcal is a single representative value (put ranges in notes)\n- notes should include uncertainty or 2-3 alternatives if relevant\n"
+        "- Be conservative on calories; if not confident in the label, use 'unknown' and list alternatives in notes.\n"
+        + ("Allowed labels: " + ", ".join(allowed_labels_ascii) + "\n" if allowed_labels_ascii else "")
+    )
+    _static_cache["prefix"] = prefix
+    return prefix
+
+
+def _image_detail() -> str:
+    detail = os.getenv("IMAGE_DETAIL", "auto").lower()
+    return detail if detail in {"low", "high", "auto"} else "auto"
+
+
+def _responses_input(prefix: str, prompt_text: str, b64_image: str) -> list:
+    return [
+        {"role": "system", "content": [{"type": "input_text", "text": prefix}]},
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": prompt_text},
+                {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64_image}", "detail": _image_detail()},
+            ],
+        },
+    ]
+
+
+def _chat_messages(prefix: str, prompt_text: str, b64_image: str) -> list:
+    return [
+        {"role": "system", "content": prefix},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt_text},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}", "detail": _image_detail()}},
+            ],
+        },
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Token usage accounting (per mode and model)
+# ---------------------------------------------------------------------------
+
+# USD per 1M tokens: (input, cached input, output). Override with MODEL_PRICES_JSON,
+# e.g. {"gpt-4o-mini": [0.15, 0.075, 0.6]}. Dated snapshots match by prefix.
+_DEFAULT_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+_usage_lock = threading.Lock()
+_usage_totals: dict = {}
+
+
+def _model_prices(model: str):
+    prices = dict(_DEFAULT_PRICES)
+    override = os.getenv("MODEL_PRICES_JSON")
+    if override:
+        try:
+            prices.update({k: tuple(v) for k, v in json.loads(override).items()})
+        except Exception:
+            pass
+    for name in sorted(prices, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return prices[name]
+    return None
+
+
+def _field(obj, name: str):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _extract_usage(response) -> dict | None:
+    """Normalize Responses / Chat Completions usage blocks to input/cached/output tokens."""
+    usage = _field(response, "usage")
+    if usage is None:
+        return None
+    input_tokens = _field(usage, "input_tokens")
+    if input_tokens is None:
+        input_tokens = _field(usage, "prompt_tokens")
+    output_tokens = _field(usage, "output_tokens")
+    if output_tokens is None:
+        output_tokens = _field(usage, "completion_tokens")
+    details = _field(usage, "input_tokens_details") or _field(usage, "prompt_tokens_details")
+    cached_tokens = _field(details, "cached_tokens")
+    return {
+        "input_tokens": int(input_tokens or 0),
+        "cached_tokens": int(cached_tokens or 0),
+        "output_tokens": int(output_tokens or 0),
+    }
+
+
+def _record_usage(model: str, mode: str, usage: dict | None) -> dict | None:
+    if usage is None:
+        return None
+    usage = dict(usage, model=model, mode=mode)
+    prices = _model_prices(model)
+    if prices:
+        uncached = max(usage["input_tokens"] - usage["cached_tokens"], 0)
+        usage["cost_usd"] = round(
+            (uncached * prices[0] + usage["cached_tokens"] * prices[1] + usage["output_tokens"] * prices[2]) / 1e6, 8
+        )
+    with _usage_lock:
+        bucket = _usage_totals.setdefault((mode, model), {
+            "calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost_usd": 0.0,
+        })
+        bucket["calls"] += 1
+        for k in ("input_tokens", "cached_tokens", "output_tokens"):
+            bucket[k] += usage[k]
+        bucket["cost_usd"] += usage.get("cost_usd", 0.0)
+    return usage
+
+
+def get_usage_stats() -> list:
+    """Accumulated token usage and estimated cost per (mode, model) in this worker."""
+    with _usage_lock:
+        return [
+            dict(v, mode=mode, model=model, cost_usd=round(v["cost_usd"], 6))
+            for (mode, model), v in sorted(_usage_totals.items())
+        ]
+
+
+def _responses_http_call(api_key: str, model: str, prefix: str, prompt_text: str, b64_image: str, include_schema: bool = True, timeout: float | None = None):
     url = "https://api.openai.com/v1/responses"
     # Build response_format schema (structured output)
     output_lang = os.getenv("OUTPUT_LANG", "en").lower()
@@ -86,15 +262,7 @@ def _responses_http_call(api_key: str, model: str, prompt_text: str, b64_image:
     }
     payload = {
         "model": model,
-        "input": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt_text},
-                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64_image}"},
-                ],
-            }
-        ],
+        "input": _responses_input(prefix, prompt_text, b64_image),
         "max_output_tokens": 500,
         "temperature": 0,
     }
@@ -108,35 +276,28 @@ def _responses_http_call(api_key: str, model: str, prompt_text: str, b64_image:
     s = requests.Session()
     s.trust_env = False  # ignore proxy/env that may inject non-ascii headers
     data_bytes = json.dumps(payload, ensure_ascii=True).encode("ascii")
-    r = s.post(url, headers=headers, data=data_bytes, timeout=90)
+    r = s.post(url, headers=headers, data=data_bytes, timeout=timeout or 90)
     if r.status_code == 400 and include_schema:
         # Fallback without schema if server rejects response_format
-        return _responses_http_call(api_key, model, prompt_text, b64_image, include_schema=False)
+        return _responses_http_call(api_key, model, prefix, prompt_text, b64_image, include_schema=False, timeout=timeout)
     r.raise_for_status()
-    data = r.json()
+    data = json_codec.loads(r.content)
+    usage = _extract_usage(data)
     # Prefer aggregated output_text if present
     text = data.get("output_text")
     if text:
-        return text
+        return text, usage
     # Reconstruct from output structure
     out = data.get("output", [])
-    return "".join([p.get("text", "") for o in out for p in o.get("content", [])])
+    return "".join([p.get("text", "") for o in out for p in o.get("content", [])]), usage
 
 
-def _chat_completions_http_call(api_key: str, model: str, prompt_text: str, b64_image: str, include_json_object: bool = True) -> str:
+def _chat_completions_http_call(api_key: str, model: str, prefix: str, prompt_text: str, b64_image: str, include_json_object: bool = True, timeout: float | None = None):
     url = "https://api.openai.com/v1/chat/completions"
     # Ask for a JSON object; schema enforcement not supported here
     payload = {
         "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt_text},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"}},
-                ],
-            }
-        ],
+        "messages": _chat_messages(prefix, prompt_text, b64_image),
         "max_tokens": 500,
         "temperature": 0,
     }
@@ -150,51 +311,54 @@ def _chat_completions_http_call(api_key: str, model: str, prompt_text: str, b64_
     s = requests.Session()
     s.trust_env = False
     data_bytes = json.dumps(payload, ensure_ascii=True).encode("ascii")
-    r = s.post(url, headers=headers, data=data_bytes, timeout=90)
+    r = s.post(url, headers=headers, data=data_bytes, timeout=timeout or 90)
     if r.status_code == 400 and include_json_object:
         # Retry without response_format (older API)
-        return _chat_completions_http_call(api_key, model, prompt_text, b64_image, include_json_object=False)
+        return _chat_completions_http_call(api_key, model, prefix, prompt_text, b64_image, include_json_object=False, timeout=timeout)
     r.raise_for_status()
-    data = r.json()
-    return data["choices"][0]["message"]["content"]
+    data = json_codec.loads(r.content)
+    return data["choices"][0]["message"]["content"], _extract_usage(data)
 
 
-def classify_image_base64(b64_image: str, prompt_override: str | None = None):
+def _correct_label(parsed: dict, allowed_labels: list) -> None:
+    """Fuzzy-correct parsed['label'] to the allowed list, or set 'unknown'."""
+    label = str(parsed.get("label", "")).lower().strip()
+    if label and label not in [l.lower() for l in allowed_labels] and label != "unknown":
+        # Fuzzy match
+        candidates = difflib.get_close_matches(label, allowed_labels, n=1, cutoff=0.6)
+        if candidates:
+            parsed["label_original"] = label
+            parsed["label"] = candidates[0]
+            note_extra = f"자동 교정: '{label}' -> '{candidates[0]}' (fuzzy)"
+            notes = parsed.get("notes", "")
+            parsed["notes"] = (notes + ("; " if notes else "") + note_extra)[:400]
+        else:
+            # Insert unknown fallback if no reasonable match
+            parsed["label_original"] = label
+            parsed["label"] = "unknown"
+            notes = parsed.get("notes", "")
+            parsed["notes"] = (notes + ("; " if notes else "") + "허용 목록과 불일치하여 unknown 처리")[:400]
+
+
+def classify_image_base64(b64_image: str, prompt_override: str | None = None, model: str | None = None, usage_mode: str = "classify", timeout: float | None = None):
     api_key = os.getenv("OPENAI_API_KEY")
-    requested_model = _normalize_model(os.getenv("CHAT_MODEL", "gpt-4o-mini"))
+    requested_model = _normalize_model(model or os.getenv("CHAT_MODEL", "gpt-4o-mini"))
     output_lang = os.getenv("OUTPUT_LANG", "en").lower()
 
-    # Load allowed labels list if present for constrained classification
-    labels_path = os.path.join(os.path.dirname(__file__), "food_labels.json")
-    allowed_labels = []
-    if os.path.exists(labels_path):
-        try:
-            with open(labels_path, "r", encoding="utf-8") as f:
-                allowed_labels = json.load(f)
-        except Exception:
-            allowed_labels = []
-
-    # Ensure ASCII-only labels for tricky environments
-    allowed_labels_ascii = [_ascii_clean(str(x)) for x in allowed_labels]
-    label_block = "\nAllowed labels: " + ", ".join(allowed_labels_ascii) if allowed_labels_ascii else ""
+    # Allowed labels (constrained classification) live in the static prefix
+    allowed_labels = _load_allowed_labels()
+    prefix = _static_prefix()
 
-    # ASCII-only prompt (English) to avoid any encoding issues on some environments.
-    schema_base = (
-        "{\n  \"label\": string,\n  \"confidence\": number,\n  \"calories_kcal\": number,\n  \"serving\": string,\n  \"notes\": string\n}\n"
-    )
     ko_instruction = (
+        "Output language: Korean fields requested. "
         "Additionally, include 'label_ko', 'serving_ko', and 'notes_ko' with Korean strings. "
         "'label' must still be from the English allowed list, but 'label_ko' is the Korean name.\n"
         if output_lang == "ko" else ""
     )
     prompt = prompt_override or (
         "Look at the image and return the best-matching food label (use one from the allowed list or 'unknown') and an average calorie estimate.\n"
-        "Respond with JSON only, no extra text. JSON schema (base):\n"
-        + schema_base +
-        ("Output language: Korean fields requested. " + ko_instruction if output_lang == "ko" else "") +
-        "Rules:\n- label must be from the allowed list or 'unknown'\n- confidence is 0..1\n- calories_kcal is a single representative value (put ranges in notes)\n- notes should include uncertainty or 2-3 alternatives if relevant\n"
-        + label_block + "\n"
-        "Be conservative on calories; if not confident in the label, use 'unknown' and list alternatives in notes."
+        "Respond with JSON only, no extra text, following the schema above.\n"
+        + ko_instruction
     )
 
     if not api_key:
@@ -228,9 +392,11 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
         "gpt-4.1-mini-vision": "gpt-4-vision-preview",  # will deprecate
     }
 
+    usage = None
     if use_new:
         try:
-            client = OpenAI(api_key=api_key)
+            # explicit timeout (hedged calls): fail fast, no SDK-level retries
+            client = OpenAI(api_key=api_key, timeout=timeout, max_retries=0) if timeout else OpenAI(api_key=api_key)
             # Build structured output schema (for newer SDKs)
             properties = {
                 "label": {"type": "string"},
@@ -250,15 +416,7 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
             try:
                 response = client.responses.create(
                     model=requested_model,
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "input_text", "text": prompt},
-                                {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64_image}"},
-                            ],
-                        }
-                    ],
+                    input=_responses_input(prefix, prompt, b64_image),
                     max_output_tokens=500,
                     temperature=0,
                     response_format={
@@ -279,21 +437,14 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
                 # Older SDK without response_format kw; retry without it
                 response = client.responses.create(
                     model=requested_model,
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "input_text", "text": prompt},
-                                {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64_image}"},
-                            ],
-                        }
-                    ],
+                    input=_responses_input(prefix, prompt, b64_image),
                     max_output_tokens=500,
                     temperature=0,
                 )
             text = getattr(response, "output_text", "") or "".join(
                 [p.get("text", "") for o in getattr(response, "output", []) for p in o.get("content", [])]
             )
+            usage = _extract_usage(response)
         except Exception as e:
             # Fallback to Chat Completions if encoding error occurs
             if "ascii" in str(e).lower() or "encode" in str(e).lower():
@@ -301,18 +452,7 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
                     try:
                         chat = client.chat.completions.create(
                             model=requested_model,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {"type": "text", "text": prompt},
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"},
-                                        },
-                                    ],
-                                }
-                            ],
+                            messages=_chat_messages(prefix, prompt, b64_image),
                             max_tokens=500,
                             temperature=0,
                             response_format={"type": "json_object"},
@@ -321,47 +461,37 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
                         # Older SDK without response_format
                         chat = client.chat.completions.create(
                             model=requested_model,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {"type": "text", "text": prompt},
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"},
-                                        },
-                                    ],
-                                }
-                            ],
+                            messages=_chat_messages(prefix, prompt, b64_image),
                             max_tokens=500,
                             temperature=0,
                         )
                     text = chat.choices[0].message.content
+                    usage = _extract_usage(chat)
                 except Exception as ee:
                     # Last resort: sanitize prompt to pure ASCII and retry Responses once
                     try:
                         prompt2 = _ascii_clean(prompt)
                         # Try raw HTTP to responses endpoint (utf-8)
                         try:
-                            text = _responses_http_call(api_key, requested_model, prompt2, b64_image, include_schema=True)
+                            text, usage = _responses_http_call(api_key, requested_model, prefix, prompt2, b64_image, include_schema=True, timeout=timeout)
                         except Exception:
-                            text = _responses_http_call(api_key, requested_model, prompt2, b64_image, include_schema=False)
+                            text, usage = _responses_http_call(api_key, requested_model, prefix, prompt2, b64_image, include_schema=False, timeout=timeout)
                     except Exception as e3:
                         # Try raw HTTP to chat completions as final attempt
                         try:
                             try:
-                                text = _chat_completions_http_call(api_key, requested_model, prompt2, b64_image, include_json_object=True)
+                                text, usage = _chat_completions_http_call(api_key, requested_model, prefix, prompt2, b64_image, include_json_object=True, timeout=timeout)
                             except Exception:
-                                text = _chat_completions_http_call(api_key, requested_model, prompt2, b64_image, include_json_object=False)
+                                text, usage = _chat_completions_http_call(api_key, requested_model, prefix, prompt2, b64_image, include_json_object=False, timeout=timeout)
                         except Exception as e4:
                             raise RuntimeError(f"OpenAI new API call failed (fallback also failed): {e4}")
             else:
                 # If failure is due to response_format kw on older SDK, try raw HTTP path
                 if isinstance(e, TypeError) and "response_format" in str(e):
                     try:
-                        text = _responses_http_call(api_key, requested_model, prompt, b64_image, include_schema=True)
+                        text, usage = _responses_http_call(api_key, requested_model, prefix, prompt, b64_image, include_schema=True, timeout=timeout)
                     except Exception:
-                        text = _responses_http_call(api_key, requested_model, prompt, b64_image, include_schema=False)
+                        text, usage = _responses_http_call(api_key, requested_model, prefix, prompt, b64_image, include_schema=False, timeout=timeout)
                 else:
                     raise RuntimeError(f"OpenAI new API call failed: {e}")
     else:
@@ -378,36 +508,26 @@ def classify_image_base64(b64_image: str, prompt_override: str | None = None):
         try:
             resp = openai.ChatCompletion.create(
                 model=legacy_model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=[{"role": "system", "content": prefix}, {"role": "user", "content": prompt}],
                 max_tokens=512,
                 temperature=0.0,
+                **({"request_timeout": timeout} if timeout else {}),
             )
             text = resp["choices"][0]["message"]["content"]
+            usage = _extract_usage(resp)
         except Exception as e:
             raise RuntimeError(f"OpenAI legacy call failed: {e}. SDK 버전 확인 및 'pip install --upgrade openai' 수행 후 vision 전용 모델 사용을 권장합니다.")
 
-    parsed = _safe_json_parse(text)
+    usage = _record_usage(requested_model, usage_mode, usage)
+    parsed = json_codec.parse_result(text)
     if parsed is None:
-        return {"raw": text}
+        return {"raw": text, "usage": usage}
 
     # If label not in allowed list and list exists, attempt fuzzy correction
     if allowed_labels and isinstance(parsed, dict):
-        label = str(parsed.get("label", "")).lower().strip()
-        if label and label not in [l.lower() for l in allowed_labels] and label != "unknown":
-            # Fuzzy match
-            candidates = difflib.get_close_matches(label, allowed_labels, n=1, cutoff=0.6)
-            if candidates:
-                parsed["label_original"] = label
-                parsed["label"] = candidates[0]
-                note_extra = f"자동 교정: '{label}' -> '{candidates[0]}' (fuzzy)"
-                notes = parsed.get("notes", "")
-                parsed["notes"] = (notes + ("; " if notes else "") + note_extra)[:400]
-            else:
-                # Insert unknown fallback if no reasonable match
-                parsed["label_original"] = label
-                parsed["label"] = "unknown"
-                notes = parsed.get("notes", "")
-                parsed["notes"] = (notes + ("; " if notes else "") + "허용 목록과 불일치하여 unknown 처리")[:400]
+        _correct_label(parsed, allowed_labels)
+    if isinstance(parsed, dict) and usage:
+        parsed["usage"] = usage
     return parsed
 
 
@@ -421,14 +541,8 @@ def classify_image_base64_reasoned(b64_image: str, primary_model_env: str = "CHA
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY 환경변수가 설정되지 않았습니다.")
 
-    labels_path = os.path.join(os.path.dirname(__file__), "food_labels.json")
-    allowed_labels = []
-    if os.path.exists(labels_path):
-        try:
-            with open(labels_path, "r", encoding="utf-8") as f:
-                allowed_labels = json.load(f)
-        except Exception:
-            allowed_labels = []
+    allowed_labels = _load_allowed_labels()
+    prefix = _static_prefix()
 
     primary = _normalize_model(os.getenv(primary_model_env, os.getenv("CHAT_MODEL", "gpt-4o-mini")))
     fallback = _normalize_model(os.getenv(fallback_model_env, "gpt-4.1-mini"))
@@ -436,15 +550,13 @@ def classify_image_base64_reasoned(b64_image: str, primary_model_env: str = "CHA
         fallback = None  # avoid duplicate call
     output_lang = os.getenv("OUTPUT_LANG", "en").lower()
 
-    # Lightweight first reasoning prompt
+    # Lightweight first reasoning prompt (allowed list comes from the shared prefix)
     reasoning_prompt = (
         "List up to 4 food label candidates from the image with a short reason for each. Exclude labels not in the allowed list. "
-        "Output format: 'label1 | reason; label2 | reason; ...'"
-        + (" Allowed list: " + ", ".join(allowed_labels) if allowed_labels else "")
+        "Output format: 'label1 | reason; label2 | reason; ...' (plain text, not JSON)"
     )
 
     def _call_model(model_name: str, text_prompt: str, image_b64: str):
-        os.environ["CHAT_MODEL"] = model_name  # reuse underlying function path
         # Reuse low-level path with simplified JSON-free prompt when reasoning phase
         api_key_inner = os.getenv("OPENAI_API_KEY")
         if not (OpenAI or openai):
@@ -455,33 +567,31 @@ def classify_image_base64_reasoned(b64_image: str, primary_model_env: str = "CHA
             client = OpenAI(api_key=api_key_inner)
             resp = client.responses.create(
                 model=model_name,
-                input=[{"role": "user", "content": [
-                    {"type": "input_text", "text": text_prompt},
-                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{image_b64}"},
-                ]}],
+                input=_responses_input(prefix, text_prompt, image_b64),
                 max_output_tokens=400,
                 temperature=0,
             )
-            return getattr(resp, "output_text", "") or "".join([
+            text = getattr(resp, "output_text", "") or "".join([
                 p.get("text", "") for o in getattr(resp, "output", []) for p in o.get("content", [])
             ])
         else:
             if not (openai and hasattr(openai, "ChatCompletion")):
                 raise RuntimeError("레거시 ChatCompletion 사용 불가. openai 업그레이드 필요.")
             openai.api_key = api_key_inner
-            r = openai.ChatCompletion.create(
+            resp = openai.ChatCompletion.create(
                 model=model_name,
-                messages=[{"role": "user", "content": text_prompt}],
+                messages=[{"role": "system", "content": prefix}, {"role": "user", "content": text_prompt}],
                 max_tokens=400,
                 temperature=0,
             )
-            return r["choices"][0]["message"]["content"]
+            text = resp["choices"][0]["message"]["content"]
+        return text, _record_usage(model_name, "reasoning_candidates", _extract_usage(resp))
 
     try:
-        reasoning_text = _call_model(primary, reasoning_prompt, b64_image)
+        reasoning_text, reasoning_usage = _call_model(primary, reasoning_prompt, b64_image)
     except Exception:
         # fallback directly to single-pass
-        return classify_image_base64(b64_image)
+        return classify_image_base64(b64_image, model=primary)
 
     # Extract candidate labels
     candidates_raw = [seg.strip() for seg in reasoning_text.split(";") if seg.strip()]
@@ -503,14 +613,13 @@ def classify_image_base64_reasoned(b64_image: str, primary_model_env: str = "CHA
     final_prompt = (
         "Choose the single best label from the candidates for the image, or use 'unknown' if not confident. Respond ONLY with JSON.\n"
         "Candidates: " + (candidate_block if candidate_block else "(none)") + "\n"
-        "Follow the same JSON schema {label, confidence, calories_kcal, serving, notes}. Put alternatives/uncertainty in notes. "
+        "Follow the JSON schema above {label, confidence, calories_kcal, serving, notes}. Put alternatives/uncertainty in notes. "
         + ko_addendum
     )
 
     # Use fallback (larger) model if available
     target_model = fallback or primary
-    os.environ["CHAT_MODEL"] = target_model
-    final_result = classify_image_base64(b64_image, prompt_override=final_prompt)
+    final_result = classify_image_base64(b64_image, prompt_override=final_prompt, model=target_model, usage_mode="reasoning_final")
     # Attach reasoning trace if dict
     if isinstance(final_result, dict):
         final_result["reasoning_trace"] = {
@@ -518,5 +627,327 @@ def classify_image_base64_reasoned(b64_image: str, primary_model_env: str = "CHA
             "fallback_model": target_model,
             "raw_reasoning": reasoning_text,
             "candidates": candidates,
+            "usage": reasoning_usage,
         }
     return final_result
+
+
+def classify_crops_base64(crops_b64: list, model: str | None = None) -> list:
+    """Classify several crops of one plate in a single multi-image request.
+    Returns one result dict per crop (same order); None where the model gave no item.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY 환경변수가 설정되지 않았습니다.")
+    if OpenAI is None:
+        raise RuntimeError("다중 이미지 요청은 새 openai SDK가 필요합니다: pip install --upgrade openai")
+    if not crops_b64:
+        return []
+    requested_model = _normalize_model(model or os.getenv("CHAT_MODEL", "gpt-4o-mini"))
+    output_lang = os.getenv("OUTPUT_LANG", "en").lower()
+    allowed_labels = _load_allowed_labels()
+    prefix = _static_prefix()
+
+    prompt = (
+        f"The {len(crops_b64)} images are crops of ONE meal photo, each showing (mostly) one dish. "
+        "For every image, in order, classify the dish and estimate its calories as served.\n"
+        "Respond with JSON only: {\"items\": [{\"index\": 0-based image index, plus the schema fields above}]}\n"
+        + ("Also include 'label_ko', 'serving_ko', and 'notes_ko' in Korean for each item. 'label' remains from the English allowed list.\n"
+           if output_lang == "ko" else "")
+    )
+    detail = _image_detail()
+    content = [{"type": "input_text", "text": prompt}] + [
+        {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b}", "detail": detail} for b in crops_b64
+    ]
+    client = OpenAI(api_key=api_key)
+    try:
+        response = client.responses.create(
+            model=requested_model,
+            input=[
+                {"role": "system", "content": [{"type": "input_text", "text": prefix}]},
+                {"role": "user", "content": content},
+            ],
+            max_output_tokens=250 * len(crops_b64),
+            temperature=0,
+        )
+    except Exception as e:
+        raise RuntimeError(f"OpenAI multi-image call failed: {e}")
+    text = getattr(response, "output_text", "") or "".join(
+        [p.get("text", "") for o in getattr(response, "output", []) for p in o.get("content", [])]
+    )
+    usage = _record_usage(requested_model, "multi_escalation", _extract_usage(response))
+
+    parsed = json_codec.extract_json_object(text) or {}
+    results = [None] * len(crops_b64)
+    for pos, item in enumerate(parsed.get("items") or []):
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.pop("index", pos))
+        except (TypeError, ValueError):
+            idx = pos
+        if not 0 <= idx < len(results):
+            continue
+        item = json_codec.parse_result(item)
+        if allowed_labels:
+            _correct_label(item, allowed_labels)
+        results[idx] = item
+    if usage:
+        # one request for all crops; attach the shared usage to the first result
+        for r in results:
+            if r is not None:
+                r["usage"] = usage
+                break
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Hedged requests + circuit breaker
+#
+# Primary CHAT_MODEL is called first; if it has not answered within the
+# HEDGE_PERCENTILE of recent primary latencies, the same request is sent to
+# CHAT_MODEL_FALLBACK and whichever finishes first wins. A circuit breaker
+# counts consecutive failures / latency spikes and, while open, routes traffic
+# to the local model until a probe request shows upstream is healthy again.
+# Hedges are budgeted: at most HEDGE_MAX_RATIO of the last HEDGE_WINDOW
+# upstream requests may be hedged, so a provider-wide slowdown cannot double
+# upstream load before the breaker trips.
+# ---------------------------------------------------------------------------
+
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_MAX_WORKERS", "16")), thread_name_prefix="chat-hedge")
+_routing_lock = threading.Lock()
+_primary_latencies: deque = deque(maxlen=int(os.getenv("HEDGE_WINDOW", "200")))
+_hedge_history: deque = deque(maxlen=int(os.getenv("HEDGE_WINDOW", "200")))  # True = hedged
+
+_BREAKER_CLOSED = "closed"
+_BREAKER_OPEN = "open"
+_BREAKER_HALF_OPEN = "half_open"
+
+_breaker = {
+    "state": _BREAKER_CLOSED,
+    "consecutive_failures": 0,
+    "opened_at": 0.0,
+    "probe_in_flight": False,
+}
+_routing_stats = {
+    "requests": 0,
+    "hedged": 0,
+    "fallback_on_error": 0,
+    "hedge_over_budget": 0,
+    "wins": {},
+    "local_routed": 0,
+    "breaker_transitions": [],
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _hedge_delay() -> float:
+    """Seconds to wait on the primary before firing the hedge request."""
+    default_delay = _env_float("HEDGE_DELAY_DEFAULT_S", 8.0)
+    percentile = min(max(_env_float("HEDGE_PERCENTILE", 95.0), 0.0), 100.0)
+    min_samples = int(_env_float("HEDGE_MIN_SAMPLES", 20))
+    with _routing_lock:
+        samples = sorted(_primary_latencies)
+    if len(samples) < min_samples:
+        return default_delay
+    idx = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+    return samples[idx]
+
+
+def _hedge_allowed() -> bool:
+    """Take a hedge from the budget if the recent hedge ratio is below HEDGE_MAX_RATIO."""
+    max_ratio = _env_float("HEDGE_MAX_RATIO", 0.1)
+    with _routing_lock:
+        recent = sum(_hedge_history) / len(_hedge_history) if _hedge_history else 0.0
+        allowed = recent < max_ratio
+        _hedge_history.append(allowed)
+        if not allowed:
+            _routing_stats["hedge_over_budget"] += 1
+        return allowed
+
+
+def _set_breaker_state(new_state: str, reason: str):
+    # caller holds _routing_lock
+    old_state = _breaker["state"]
+    if old_state == new_state:
+        return
+    _breaker["state"] = new_state
+    if new_state == _BREAKER_OPEN:
+        _breaker["opened_at"] = time.monotonic()
+    if new_state == _BREAKER_CLOSED:
+        _breaker["consecutive_failures"] = 0
+    transitions = _routing_stats["breaker_transitions"]
+    transitions.append({"from": old_state, "to": new_state, "reason": reason, "at": time.time()})
+    del transitions[:-50]  # keep the recent history only
+
+
+def _breaker_admit() -> str:
+    """Return 'upstream', 'probe' or 'local' for the next request."""
+    cooldown = _env_float("CIRCUIT_COOLDOWN_S", 30.0)
+    with _routing_lock:
+        state = _breaker["state"]
+        if state == _BREAKER_CLOSED:
+            return "upstream"
+        if state == _BREAKER_OPEN and time.monotonic() - _breaker["opened_at"] >= cooldown:
+            _set_breaker_state(_BREAKER_HALF_OPEN, "cooldown elapsed")
+            state = _BREAKER_HALF_OPEN
+        if state == _BREAKER_HALF_OPEN and not _breaker["probe_in_flight"]:
+            _breaker["probe_in_flight"] = True
+            return "probe"
+        return "local"
+
+
+def _breaker_record(ok: bool, elapsed: float, probe: bool):
+    spike = _env_float("CIRCUIT_LATENCY_SPIKE_S", 30.0)
+    threshold = int(_env_float("CIRCUIT_FAILURE_THRESHOLD", 5))
+    healthy = ok and elapsed < spike
+    reason = "error" if not ok else f"latency spike ({elapsed:.1f}s)"
+    with _routing_lock:
+        if probe:
+            # only the probe's own result moves the breaker out of HALF_OPEN
+            _breaker["probe_in_flight"] = False
+            if healthy:
+                _set_breaker_state(_BREAKER_CLOSED, "probe succeeded")
+            else:
+                _breaker["consecutive_failures"] += 1
+                _set_breaker_state(_BREAKER_OPEN, "probe failed: " + reason)
+            return
+        if healthy:
+            # late successes of requests admitted before the breaker opened
+            # reset the counter but never close an OPEN breaker
+            _breaker["consecutive_failures"] = 0
+            return
+        _breaker["consecutive_failures"] += 1
+        if _breaker["state"] == _BREAKER_CLOSED and _breaker["consecutive_failures"] >= threshold:
+            _set_breaker_state(_BREAKER_OPEN, f"{_breaker['consecutive_failures']} consecutive failures, last: {reason}")
+
+
+def _timed_classify(b64_image: str, model: str, is_primary: bool):
+    started = time.monotonic()
+    # bounded per-call timeout (no SDK retries) so abandoned losing calls free
+    # their pool thread instead of waiting out the SDK's 600 s default
+    timeout = _env_float("HEDGE_CALL_TIMEOUT_S", 30.0)
+    result = classify_image_base64(b64_image, model=model, timeout=timeout)
+    if is_primary:
+        # only successful primary calls shape the hedge delay
+        with _routing_lock:
+            _primary_latencies.append(time.monotonic() - started)
+    return result
+
+
+def _local_fallback(b64_image: str, reason: str):
+    from local_model_fixed import local_inference
+
+    res = local_inference(base64.b64decode(b64_image))
+    res["routed_to"] = "local"
+    res["routing_reason"] = reason
+    return res
+
+
+def _hedged_upstream(b64_image: str, primary: str, fallback: str | None):
+    primary_future = _HEDGE_POOL.submit(_timed_classify, b64_image, primary, True)
+    futures = {primary_future: primary}
+    done, _ = wait([primary_future], timeout=_hedge_delay())
+    primary_failed = bool(done) and primary_future.exception() is not None
+    if fallback and not done:
+        # slow primary -> hedge, if the budget allows
+        if _hedge_allowed():
+            with _routing_lock:
+                _routing_stats["hedged"] += 1
+            futures[_HEDGE_POOL.submit(_timed_classify, b64_image, fallback, False)] = fallback
+    else:
+        with _routing_lock:
+            _hedge_history.append(False)
+        if fallback and primary_failed:
+            # primary failed early -> plain fallback (a retry, not a hedge)
+            with _routing_lock:
+                _routing_stats["fallback_on_error"] += 1
+            futures[_HEDGE_POOL.submit(_timed_classify, b64_image, fallback, False)] = fallback
+
+    pending = set(futures)
+    last_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            try:
+                result = fut.result()
+            except Exception as e:
+                last_error = e
+                continue
+            # losing call keeps running in the pool; its result is discarded
+            return futures[fut], result
+    raise last_error or RuntimeError("hedged request failed")
+
+
+def classify_image_base64_hedged(b64_image: str, primary_model_env: str = "CHAT_MODEL", fallback_model_env: str = "CHAT_MODEL_FALLBACK"):
+    """Single-pass classification with hedging and a circuit breaker.
+    Falls back to the local model while the breaker is open.
+    """
+    primary = _normalize_model(os.getenv(primary_model_env, "gpt-4o-mini"))
+    fallback = _normalize_model(os.getenv(fallback_model_env, ""))
+    if fallback == primary:
+        fallback = None
+
+    with _routing_lock:
+        _routing_stats["requests"] += 1
+    route = _breaker_admit()
+    if route == "local":
+        with _routing_lock:
+            _routing_stats["local_routed"] += 1
+        return _local_fallback(b64_image, "circuit breaker " + _breaker["state"])
+
+    started = time.monotonic()
+    try:
+        winner, result = _hedged_upstream(b64_image, primary, fallback)
+    except Exception as e:
+        _breaker_record(False, time.monotonic() - started, route == "probe")
+        with _routing_lock:
+            opened = _breaker["state"] == _BREAKER_OPEN
+            if opened:
+                _routing_stats["local_routed"] += 1
+        if opened:
+            return _local_fallback(b64_image, f"upstream failed: {e}")
+        raise
+    _breaker_record(True, time.monotonic() - started, route == "probe")
+    with _routing_lock:
+        wins = _routing_stats["wins"]
+        wins[winner] = wins.get(winner, 0) + 1
+    if isinstance(result, dict):
+        result["routed_to"] = winner
+    return result
+
+
+def get_routing_stats() -> dict:
+    """Snapshot of hedge rate, wins per model and breaker state."""
+    with _routing_lock:
+        requests_total = _routing_stats["requests"]
+        samples = list(_primary_latencies)
+        recent_hedges = list(_hedge_history)
+        stats = {
+            "requests": requests_total,
+            "hedged": _routing_stats["hedged"],
+            "hedge_rate": (_routing_stats["hedged"] / requests_total) if requests_total else 0.0,
+            "fallback_on_error": _routing_stats["fallback_on_error"],
+            "hedge_budget": {
+                "max_ratio": _env_float("HEDGE_MAX_RATIO", 0.1),
+                "recent_ratio": (sum(recent_hedges) / len(recent_hedges)) if recent_hedges else 0.0,
+                "window": len(recent_hedges),
+                "over_budget": _routing_stats["hedge_over_budget"],
+            },
+            "wins": dict(_routing_stats["wins"]),
+            "local_routed": _routing_stats["local_routed"],
+            "breaker": {
+                "state": _breaker["state"],
+                "consecutive_failures": _breaker["consecutive_failures"],
+                "transitions": list(_routing_stats["breaker_transitions"]),
+            },
+            "primary_latency_samples": len(samples),
+        }
+    stats["hedge_delay_s"] = _hedge_delay()
+    return stats
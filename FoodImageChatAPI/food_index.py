@@ -0,0 +1,253 @@
+"""Nearest-neighbour index of food label embeddings for local mode.
+
+Build from a folder with one sub-folder per food label (names from food_labels.json):
+
+    python food_index.py build ./reference_images --out .cache/food_index
+
+Files written (all next to each other):
+    <out>.npy            float32 (N, D) L2-normalized embeddings, rows grouped by label
+    <out>.centroids.npy  float32 (L, D) normalized per-label mean embedding
+    <out>.json           labels, row offsets per label, dim, similarity calibration
+
+A sub-folder named `_background` (empty table, plates, tray, hands...) is stored
+as the reserved label BACKGROUND_LABEL; crops nearest to it are rejected as
+"not food" in multi-item mode instead of getting the nearest food's calories.
+
+Scores are cosine similarities of L2-normalized MobileNetV2 pooled features.
+Those features are non-negative (ReLU6), so even unrelated images score well
+above 0; absolute thresholds are therefore calibrated per index at build time
+from leave-one-out similarities of the reference images (see _calibrate).
+
+app.py loads the index in its startup hook; the .npy files are opened with
+mmap_mode="r", so workers share pages. A rebuilt index (new .json mtime) is
+picked up by every worker on its next local request, no restart needed.
+Search is one matrix product over the normalized rows (cosine similarity) and a
+per-label max via np.maximum.reduceat. For large reference sets the centroids
+act as a coarse quantizer: only rows of the `probe` closest labels are scored.
+"""
+import os
+import sys
+import json
+import threading
+
+_IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+BACKGROUND_LABEL = "_background"
+_DEFAULT_PATH = os.path.join(os.path.dirname(__file__), ".cache", "food_index")
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+
+class FoodIndex:
+    def __init__(self, embeddings, centroids, labels: list, offsets: list, calibration: dict | None = None):
+        import numpy as np
+
+        self.calibration = calibration or {}
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.labels = labels
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ends = np.append(self.offsets[1:], embeddings.shape[0])
+
+    @property
+    def size(self) -> int:
+        return int(self.embeddings.shape[0])
+
+    @classmethod
+    def load(cls, path: str):
+        import numpy as np
+
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        embeddings = np.load(path + ".npy", mmap_mode="r")
+        centroids = np.load(path + ".centroids.npy", mmap_mode="r")
+        return cls(embeddings, centroids, meta["labels"], meta["offsets"], meta.get("calibration"))
+
+    def search(self, queries, k: int = 3, probe: int | None = None):
+        """Top-k food labels per query row.
+
+        queries: (B, D) or (D,) normalized embeddings.
+        probe: score only rows of the `probe` labels nearest by centroid (approximate);
+               None scores every row (exact).
+        Returns a list (one per query) of [{"label", "similarity"}, ...].
+        """
+        import numpy as np
+
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = max(1, min(k, len(self.labels)))
+        if probe is not None and probe < len(self.labels):
+            return [self._search_probe(row, k, probe) for row in q]
+        sims = q @ self.embeddings.T                                   # (B, N)
+        per_label = np.maximum.reduceat(sims, self.offsets, axis=1)    # (B, L)
+        top = np.argpartition(-per_label, k - 1, axis=1)[:, :k]
+        results = []
+        for b in range(q.shape[0]):
+            order = top[b][np.argsort(-per_label[b, top[b]])]
+            results.append([{"label": self.labels[i], "similarity": float(per_label[b, i])} for i in order])
+        return results
+
+    def _search_probe(self, q, k: int, probe: int):
+        import numpy as np
+
+        # score at least k labels, otherwise probe < k would return fewer than k
+        probe = max(probe, k)
+        coarse = self.centroids @ q
+        if probe >= len(coarse):
+            chosen = range(len(coarse))
+        else:
+            chosen = np.argpartition(-coarse, probe - 1)[:probe]
+        scored = []
+        for i in chosen:
+            rows = self.embeddings[self.offsets[i]:self.ends[i]]
+            scored.append((float((rows @ q).max()), int(i)))
+        scored.sort(reverse=True)
+        return [{"label": self.labels[i], "similarity": s} for s, i in scored[:k]]
+
+
+def index_path() -> str:
+    return os.getenv("FOOD_INDEX_PATH", _DEFAULT_PATH)
+
+
+def index_fingerprint() -> str:
+    """mtime of the index metadata ('' if none); changes whenever the index is rebuilt."""
+    try:
+        return str(os.path.getmtime(index_path() + ".json"))
+    except OSError:
+        return ""
+
+
+def get_index():
+    """Process-wide index, or None if no index file has been built.
+    Reloaded when the index files are rebuilt (the .json is written last).
+    """
+    global _index, _index_mtime
+    mtime = index_fingerprint()
+    if _index_mtime == mtime:
+        return _index
+    with _index_lock:
+        if _index_mtime != mtime:
+            _index = FoodIndex.load(index_path()) if mtime else None
+            _index_mtime = mtime
+        return _index
+
+
+def _calibrate(embeddings, offsets: list, labels: list) -> dict:
+    """Similarity thresholds from the reference set itself.
+
+    For every reference image: leave-one-out best similarity to another image of
+    the same label ("genuine" match score). min_similarity is the 5th percentile
+    (95% of genuine matches pass), confident_similarity the 25th percentile.
+    Background images' best similarity to any food row is recorded for reference.
+    """
+    import numpy as np
+
+    ends = list(offsets[1:]) + [embeddings.shape[0]]
+    genuine, background = [], []
+    food_rows = np.concatenate([
+        np.arange(o, e) for o, e, l in zip(offsets, ends, labels) if l != BACKGROUND_LABEL
+    ]) if any(l != BACKGROUND_LABEL for l in labels) else np.arange(0)
+    for o, e, label in zip(offsets, ends, labels):
+        rows = embeddings[o:e]
+        if label == BACKGROUND_LABEL:
+            if len(food_rows):
+                background.extend((rows @ embeddings[food_rows].T).max(axis=1).tolist())
+            continue
+        if e - o < 2:
+            continue
+        sims = rows @ rows.T
+        np.fill_diagonal(sims, -np.inf)
+        genuine.extend(sims.max(axis=1).tolist())
+    if not genuine:
+        return {}
+    cal = {
+        "min_similarity": float(np.percentile(genuine, 5)),
+        "confident_similarity": float(np.percentile(genuine, 25)),
+        "genuine_samples": len(genuine),
+    }
+    if background:
+        cal["background_p95"] = float(np.percentile(background, 95))
+    return cal
+
+
+def build_index(image_root: str, out_path: str, batch_size: int = 32) -> dict:
+    import numpy as np
+    from local_model_fixed import embed_images
+
+    labels_path = os.path.join(os.path.dirname(__file__), "food_labels.json")
+    with open(labels_path, "r", encoding="utf-8") as f:
+        known = {str(x).lower() for x in json.load(f)}
+
+    labels, offsets, chunks, centroids, skipped = [], [], [], [], []
+    total = 0
+    for name in sorted(os.listdir(image_root)):
+        folder = os.path.join(image_root, name)
+        if not os.path.isdir(folder):
+            continue
+        label = BACKGROUND_LABEL if name == BACKGROUND_LABEL else name.replace("_", " ").strip().lower()
+        if label not in known and label != BACKGROUND_LABEL:
+            skipped.append(name)
+            continue
+        files = [
+            os.path.join(folder, fn) for fn in sorted(os.listdir(folder))
+            if os.path.splitext(fn)[1].lower() in _IMAGE_EXTS
+        ]
+        if not files:
+            continue
+        vecs = []
+        for i in range(0, len(files), batch_size):
+            batch = []
+            for fp in files[i:i + batch_size]:
+                with open(fp, "rb") as f:
+                    batch.append(f.read())
+            vecs.append(embed_images(batch))
+        emb = np.concatenate(vecs).astype(np.float32)
+        centroid = emb.mean(axis=0)
+        centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+        labels.append(label)
+        offsets.append(total)
+        chunks.append(emb)
+        centroids.append(centroid)
+        total += emb.shape[0]
+
+    if not labels:
+        raise RuntimeError(f"no labelled images found under {image_root}")
+    all_embeddings = np.concatenate(chunks)
+    calibration = _calibrate(all_embeddings, offsets, labels)
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    # write to temp files and rename: running workers keep their mmap of the
+    # old inode instead of seeing a truncated file; .json goes last (reload signal)
+    tmp = f".tmp{os.getpid()}"
+    with open(out_path + ".npy" + tmp, "wb") as f:
+        np.save(f, all_embeddings)
+    with open(out_path + ".centroids.npy" + tmp, "wb") as f:
+        np.save(f, np.stack(centroids).astype(np.float32))
+    with open(out_path + ".json" + tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "labels": labels,
+            "offsets": offsets,
+            "dim": int(chunks[0].shape[1]),
+            "calibration": calibration,
+        }, f, ensure_ascii=False)
+    for suffix in (".npy", ".centroids.npy", ".json"):
+        os.replace(out_path + suffix + tmp, out_path + suffix)
+    return {"labels": len(labels), "images": total, "skipped_folders": skipped, "calibration": calibration}
+
+
+def main(argv=None):
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Build the local food embedding index")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("image_root")
+    b.add_argument("--out", default=index_path())
+    b.add_argument("--batch-size", type=int, default=32)
+    args = ap.parse_args(argv)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    info = build_index(args.image_root, args.out, args.batch_size)
+    print(json.dumps(info, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import json
+import math
+
+# Shared JSON codec for chat_client, app and result_cache.
+# Uses orjson when installed (pip install orjson), stdlib json otherwise.
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# raw_decode parses from an offset and reports where the value ended, so the
+# first balanced object in surrounding prose is found and parsed in one C pass
+_DECODER = json.JSONDecoder()
+
+# result schema: field -> expected python type(s)
+RESULT_FIELDS = {
+    "label": str,
+    "confidence": (int, float),
+    "calories_kcal": (int, float),
+    "serving": str,
+    "notes": str,
+}
+KO_FIELDS = ("label_ko", "serving_ko", "notes_ko")
+
+
+def loads(data):
+    """str/bytes -> python object. Raises ValueError on invalid JSON."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """python object -> compact UTF-8 JSON bytes (non-ASCII kept as is).
+
+    Never emits NaN / Infinity (invalid JSON): orjson writes them as null, the
+    stdlib fallback raises ValueError like starlette's JSONResponse.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def extract_json_object(text):
+    """First balanced JSON object in model text (code fences / surrounding prose ignored).
+
+    Returns the parsed dict, or None if no valid object is found.
+    """
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode("utf-8", "replace")
+    if not isinstance(text, str):
+        return None
+    stripped = text.strip()
+    if stripped.startswith("{") and stripped.endswith("}"):
+        # common case (structured output): the whole text is the object
+        try:
+            obj = loads(stripped)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            pass
+    start = text.find("{")
+    while start != -1:
+        try:
+            obj, _ = _DECODER.raw_decode(text, start)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict):
+            return obj
+        start = text.find("{", start + 1)
+    return None
+
+
+def validate_result(obj: dict) -> list:
+    """Check/coerce a classification result in place. Returns a list of schema errors."""
+    errors = []
+    for field, typ in RESULT_FIELDS.items():
+        value = obj.get(field)
+        if value is None:
+            errors.append(f"missing '{field}'")
+            continue
+        if typ is str:
+            if not isinstance(value, str):
+                obj[field] = str(value)
+            continue
+        if isinstance(value, bool) or not isinstance(value, typ):
+            try:
+                value = obj[field] = float(str(value).replace("kcal", "").strip())
+            except ValueError:
+                # e.g. true / "about 500": drop it rather than print "1 kcal"
+                obj[field] = None
+                errors.append(f"'{field}' is not a number")
+                continue
+        if not math.isfinite(value):
+            # NaN / Infinity (accepted by the JSON parsers) would print as "nan"
+            obj[field] = None
+            errors.append(f"'{field}' is not finite")
+    conf = obj.get("confidence")
+    if isinstance(conf, (int, float)) and not isinstance(conf, bool) and not 0.0 <= conf <= 1.0:
+        obj["confidence"] = min(max(float(conf), 0.0), 1.0)
+    for field in KO_FIELDS:
+        if field in obj and not isinstance(obj[field], str):
+            obj[field] = str(obj[field])
+    return errors
+
+
+def parse_result(text):
+    """Model output (str or dict) -> validated result dict, or None if no JSON object found.
+
+    Schema problems do not reject the result; they are listed under 'schema_errors'.
+    """
+    obj = text if isinstance(text, dict) else extract_json_object(text)
+    if obj is None:
+        return None
+    errors = validate_result(obj)
+    if errors:
+        obj["schema_errors"] = errors
+    return obj
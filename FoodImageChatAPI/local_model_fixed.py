@@ -1,43 +1,417 @@
 import io
+import os
+import contextlib
+import threading
 
+# MobileNetV2 is loaded once per process. Weights are memory-mapped from a
+# zip-format checkpoint (torch.load(mmap=True) + load_state_dict(assign=True)),
+# so the read-only pages are shared through the OS page cache by every worker
+# on the node instead of each worker holding a private copy.
+
+_WEIGHTS_URL = "https://download.pytorch.org/models/mobilenet_v2-b0353104.pth"
+_DEFAULT_WEIGHTS = os.path.join(os.path.dirname(__file__), ".cache", "mobilenet_v2.mmap.pt")
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def _weights_path() -> str:
+    return os.getenv("LOCAL_MODEL_WEIGHTS", _DEFAULT_WEIGHTS)
+
+
+def _export_weights(path: str):
+    """Download the torchvision checkpoint and re-save it in zip format (mmap-able)."""
+    import torch
+
+    state_dict = torch.hub.load_state_dict_from_url(_WEIGHTS_URL, map_location="cpu", progress=False)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + f".tmp{os.getpid()}"
+    torch.save(state_dict, tmp)
+    os.replace(tmp, path)  # atomic: concurrent workers never see a half-written file
+
+
+def _load_state_dict(path: str):
+    import torch
 
-def local_inference(image_bytes: bytes):
     try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True), True
+    except TypeError:
+        # torch < 2.1: no mmap support, fall back to a private copy
+        return torch.load(path, map_location="cpu"), False
+
+
+def get_model():
+    global _model
+    if _model is not None:
+        return _model
+    with _model_lock:
+        if _model is not None:
+            return _model
         import torch
-        from torchvision import transforms, models
-        from PIL import Image
+        from torchvision import models
 
-        model = models.mobilenet_v2(pretrained=True)
+        path = _weights_path()
+        if not os.path.exists(path):
+            _export_weights(path)
+        state_dict, mmapped = _load_state_dict(path)
+        # meta device: skip allocating random init weights that would be thrown away
+        with torch.device("meta") if mmapped else contextlib.nullcontext():
+            model = models.mobilenet_v2(weights=None)
+        # assign=True keeps the mmap-backed tensors instead of copying into fresh ones
+        model.load_state_dict(state_dict, assign=mmapped)
         model.eval()
+        for p in model.parameters():
+            p.requires_grad_(False)
+        _model = model
+        return _model
 
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        transform = transforms.Compose([
+
+_TRANSFORM = None
+
+
+def _transform():
+    global _TRANSFORM
+    if _TRANSFORM is None:
+        from torchvision import transforms
+
+        _TRANSFORM = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
         ])
-        tensor = transform(img).unsqueeze(0)
+    return _TRANSFORM
+
+
+def _forward(tensor):
+    """One backbone pass -> (ImageNet logits, L2-normalized 1280-d embeddings)."""
+    import torch
+
+    model = get_model()
+    with torch.no_grad():
+        feats = model.features(tensor)
+        pooled = torch.nn.functional.adaptive_avg_pool2d(feats, 1).flatten(1)
+        logits = model.classifier(pooled)
+        emb = torch.nn.functional.normalize(pooled, dim=1)
+    return logits, emb
+
+
+def embed_images(images: list):
+    """Batch of image bytes -> float32 numpy array (B, 1280), rows L2-normalized."""
+    import torch
+    from PIL import Image
+
+    tf = _transform()
+    batch = torch.stack([tf(Image.open(io.BytesIO(b)).convert("RGB")) for b in images])
+    _, emb = _forward(batch)
+    return emb.numpy()
+
+
+def local_inference(image_bytes: bytes):
+    try:
+        from PIL import Image
+        from food_index import get_index, BACKGROUND_LABEL
+
+        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        tensor = _transform()(img).unsqueeze(0)
+        logits, emb = _forward(tensor)
+
+        index = get_index()
+        if index is not None:
+            # nearest reference images -> real food labels from food_labels.json
+            top_k = int(os.getenv("FOOD_INDEX_TOP_K", "3"))
+            probe = int(os.getenv("FOOD_INDEX_PROBE", "0")) or None
+            found = index.search(emb.numpy(), k=top_k + 1, probe=probe)[0]
+            candidates = [
+                {"label": c["label"], "confidence": max(0.0, c["similarity"])}
+                for c in found if c["label"] != BACKGROUND_LABEL
+            ][:top_k]
+            if found[0]["label"] == BACKGROUND_LABEL or not candidates:
+                # nearest reference is the background class: not a food photo
+                candidates.insert(0, {"label": "unknown", "confidence": 0.0})
+            note = f"MobileNetV2 embedding nearest neighbours ({index.size} reference images)."
+        else:
+            import torch
 
-        with torch.no_grad():
-            logits = model(tensor)
             probs = torch.nn.functional.softmax(logits, dim=1)
             topk = probs[0].topk(3)
-            indices = topk.indices.tolist()
-            values = topk.values.tolist()
-
-        candidates = [
-            {"label": f"imagenet_class_{idx}", "confidence": float(conf)}
-            for idx, conf in zip(indices, values)
-        ]
+            candidates = [
+                {"label": f"imagenet_class_{idx}", "confidence": float(conf)}
+                for idx, conf in zip(topk.indices.tolist(), topk.values.tolist())
+            ]
+            note = "Placeholder MobileNetV2 (ImageNet)."
 
         return {
             "label": candidates[0]["label"],
             "confidence": candidates[0]["confidence"],
             "tags": [c["label"] for c in candidates],
             "candidates": candidates,
-            "note": "Placeholder MobileNetV2 (ImageNet).",
+            "note": note,
         }
 
     except Exception as e:
         return {"label": "unknown", "confidence": 0.0, "tags": [], "candidates": [], "error": str(e)}
+
+
+# ---------------------------------------------------------------------------
+# Multi-item mode: several foods on one plate
+#
+# Square sliding windows at a few grid scales are cropped from the photo and
+# run through the backbone in ONE batched forward pass; labels come from the
+# food index (or ImageNet logits without an index). Overlapping detections of
+# the same food are merged into one item, and per-item calories come from
+# food_calories.json. Low-confidence items are flagged as ambiguous so the
+# caller can escalate only those crops to the chat model.
+# ---------------------------------------------------------------------------
+
+_CALORIES_PATH = os.path.join(os.path.dirname(__file__), "food_calories.json")
+_calorie_table = None
+_CROP_TRANSFORM = None
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _calories() -> dict:
+    global _calorie_table
+    if _calorie_table is None:
+        import json
+
+        try:
+            with open(_CALORIES_PATH, "r", encoding="utf-8") as f:
+                _calorie_table = json.load(f)
+        except Exception:
+            _calorie_table = {}
+    return _calorie_table
+
+
+def _crop_transform():
+    global _CROP_TRANSFORM
+    if _CROP_TRANSFORM is None:
+        from torchvision import transforms
+
+        # crops are already square: resize only, no center crop
+        _CROP_TRANSFORM = transforms.Compose([
+            transforms.Resize((224, 224)),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ])
+    return _CROP_TRANSFORM
+
+
+def _window_starts(length: int, side: int, stride: int) -> list:
+    last = max(length - side, 0)
+    starts = list(range(0, last + 1, stride))
+    gap = last - starts[-1]
+    if gap > 0:
+        if gap < stride // 2 and len(starts) > 1:
+            # near-duplicate of the last window: snap it to the edge instead
+            # (never move the only window, that would uncover the start edge)
+            starts[-1] = last
+        else:
+            starts.append(last)  # make sure the right / bottom edge is covered
+    return starts
+
+
+def region_proposals(width: int, height: int, grids: tuple = (2, 3)) -> list:
+    """Square windows (left, top, right, bottom); per grid n: side = short edge / n, stride = side / 2."""
+    boxes = []
+    for n in grids:
+        side = max(1, min(width, height) // n)
+        stride = max(1, side // 2)
+        xs = _window_starts(width, side, stride)
+        ys = _window_starts(height, side, stride)
+        boxes.extend((x, y, x + side, y + side) for y in ys for x in xs)
+    return boxes
+
+
+def _overlap(a, b):
+    """(IoU, intersection / smaller area) of two boxes."""
+    iw = min(a[2], b[2]) - max(a[0], b[0])
+    ih = min(a[3], b[3]) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0, 0.0
+    inter = iw * ih
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / float(area_a + area_b - inter), inter / float(min(area_a, area_b))
+
+
+def merge_detections(detections: list, merge_iou: float = 0.3, contain: float = 0.7, cross_label_iou: float = 0.8) -> list:
+    """Merge overlapping same-label windows into one detection.
+
+    Same-label windows are linked when they really overlap (IoU >= merge_iou,
+    i.e. side-by-side windows at stride side/2, or one mostly inside the other);
+    linked windows form one group, so one dish counts once however many windows
+    it spans. A group keeps its best window as `box` (the crop used for
+    escalation and cross-label suppression) and the union of its windows as
+    `extent` (display only). A group whose box overlaps a stronger kept box of
+    another label with IoU > cross_label_iou is dropped.
+    """
+    parent = list(range(len(detections)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, a in enumerate(detections):
+        for j in range(i + 1, len(detections)):
+            b = detections[j]
+            if a["label"] != b["label"]:
+                continue
+            iou, inside = _overlap(a["box"], b["box"])
+            if iou >= merge_iou or inside >= contain:
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i, det in enumerate(detections):
+        groups.setdefault(find(i), []).append(det)
+
+    merged = []
+    for members in groups.values():
+        best = max(members, key=lambda d: d["confidence"])
+        merged.append(dict(
+            best,
+            extent=[
+                min(d["box"][0] for d in members),
+                min(d["box"][1] for d in members),
+                max(d["box"][2] for d in members),
+                max(d["box"][3] for d in members),
+            ],
+            windows=len(members),
+        ))
+
+    kept = []
+    for det in sorted(merged, key=lambda d: d["confidence"], reverse=True):
+        if all(_overlap(det["box"], k["box"])[0] <= cross_label_iou for k in kept):
+            kept.append(det)
+    return kept
+
+
+def summarize_detections(detections: list, min_score: float, ambiguous_below: float, min_margin: float) -> dict:
+    """Reject background / low-score windows, merge the rest, attach per-item calories (counted once)."""
+    from food_index import BACKGROUND_LABEL
+
+    foods = [d for d in detections if d["label"] != BACKGROUND_LABEL]
+    accepted = [d for d in foods if d["confidence"] >= min_score]
+    merged = merge_detections(accepted)
+    table = _calories()
+    items = []
+    for d in merged:
+        info = table.get(d["label"], {})
+        items.append({
+            "label": d["label"],
+            "confidence": d["confidence"],
+            "calories_kcal": info.get("calories_kcal"),
+            "serving": info.get("serving", "-"),
+            "box": d["box"],
+            "extent": d["extent"],
+            "alternatives": d["alternatives"],
+            "ambiguous": d["confidence"] < ambiguous_below or d["margin"] < min_margin,
+            "source": "local",
+        })
+    if not items and foods:
+        # nothing passed the threshold: report the best food window without
+        # calories so the caller can escalate it; it adds nothing to the total
+        best = max(foods, key=lambda d: d["confidence"])
+        items.append({
+            "label": best["label"],
+            "confidence": best["confidence"],
+            "calories_kcal": None,
+            "serving": "-",
+            "box": best["box"],
+            "extent": best["box"],
+            "alternatives": best["alternatives"],
+            "ambiguous": True,
+            "source": "local",
+        })
+    return {
+        "items": items,
+        "total_calories_kcal": sum(i["calories_kcal"] or 0 for i in items),
+        "rejected": len(detections) - len(accepted),
+    }
+
+
+def crops_jpeg_base64(image_bytes: bytes, boxes: list, max_side: int = 512) -> list:
+    """JPEG/base64 crops for escalation to the chat model."""
+    import base64
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    out = []
+    for box in boxes:
+        crop = img.crop(tuple(box))
+        crop.thumbnail((max_side, max_side))
+        buf = io.BytesIO()
+        crop.save(buf, format="JPEG", quality=85)
+        out.append(base64.b64encode(buf.getvalue()).decode("ascii"))
+    return out
+
+
+def _threshold(env_name: str, calibration: dict, key: str, default: float) -> float:
+    # explicit env override > index calibration > default
+    if os.getenv(env_name):
+        return _env_float(env_name, default)
+    return float(calibration.get(key, default))
+
+
+def local_multi_inference(image_bytes: bytes):
+    try:
+        import torch
+        from PIL import Image
+        from food_index import get_index
+
+        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        grids = tuple(int(g) for g in os.getenv("FOOD_MULTI_GRIDS", "2,3").split(",") if g.strip())
+        boxes = region_proposals(img.width, img.height, grids)
+        tf = _crop_transform()
+        batch = torch.stack([tf(img.crop(b)) for b in boxes])
+        logits, emb = _forward(batch)  # one forward pass for every crop
+
+        index = get_index()
+        detections = []
+        calibration = {}
+        if index is not None:
+            calibration = index.calibration
+            probe = int(os.getenv("FOOD_INDEX_PROBE", "0")) or None
+            for box, cands in zip(boxes, index.search(emb.numpy(), k=2, probe=probe)):
+                margin = cands[0]["similarity"] - (cands[1]["similarity"] if len(cands) > 1 else 0.0)
+                detections.append({
+                    "label": cands[0]["label"],
+                    "confidence": max(0.0, cands[0]["similarity"]),
+                    "margin": margin,
+                    "alternatives": [c["label"] for c in cands[1:]],
+                    "box": list(box),
+                })
+            note = f"{len(boxes)} regions, MobileNetV2 embedding nearest neighbours (score = cosine similarity)."
+        else:
+            probs = torch.nn.functional.softmax(logits, dim=1)
+            top = probs.topk(2, dim=1)
+            for box, vals, idxs in zip(boxes, top.values.tolist(), top.indices.tolist()):
+                detections.append({
+                    "label": f"imagenet_class_{idxs[0]}",
+                    "confidence": float(vals[0]),
+                    "margin": float(vals[0] - vals[1]),
+                    "alternatives": [f"imagenet_class_{idxs[1]}"],
+                    "box": list(box),
+                })
+            note = f"{len(boxes)} regions, placeholder MobileNetV2 (ImageNet, score = softmax probability)."
+
+        res = summarize_detections(
+            detections,
+            min_score=_threshold("FOOD_MULTI_MIN_SCORE", calibration, "min_similarity", 0.5),
+            ambiguous_below=_threshold("FOOD_MULTI_AMBIGUOUS_BELOW", calibration, "confident_similarity", 0.65),
+            min_margin=_env_float("FOOD_MULTI_MIN_MARGIN", 0.03),
+        )
+        res["regions"] = len(boxes)
+        res["note"] = note
+        return res
+
+    except Exception as e:
+        return {"items": [], "total_calories_kcal": 0, "regions": 0, "error": str(e)}
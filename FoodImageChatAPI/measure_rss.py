@@ -0,0 +1,96 @@
+"""Measure total memory of N worker processes holding the local MobileNetV2.
+
+    python measure_rss.py --workers 4
+
+"copy" reads the checkpoint the old way (private tensors per process), "mmap"
+uses local_model_fixed.get_model() (memory-mapped checkpoint); both use the
+file at LOCAL_MODEL_WEIGHTS. RSS counts shared
+pages once per process, so PSS (proportional share, Linux only) is the number
+that shows the saving; both are reported.
+"""
+import os
+import sys
+import argparse
+import multiprocessing as mp
+
+
+def _read_mem_kb(pid: int) -> dict:
+    out = {"rss": 0, "pss": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    out[key.lower()] = int(rest.split()[0])
+    except OSError:
+        # non-Linux: fall back to psutil RSS if present
+        try:
+            import psutil  # type: ignore
+
+            out["rss"] = psutil.Process(pid).memory_info().rss // 1024
+        except Exception:
+            pass
+    return out
+
+
+def _worker(mode: str, ready, stop):
+    import torch
+
+    if mode == "copy":
+        from torchvision import models
+        from local_model_fixed import _weights_path
+
+        # same checkpoint, read into private tensors (the pre-mmap behaviour)
+        model = models.mobilenet_v2(weights=None)
+        model.load_state_dict(torch.load(_weights_path(), map_location="cpu"))
+        model.eval()
+    else:
+        from local_model_fixed import get_model
+
+        model = get_model()
+    with torch.no_grad():
+        model(torch.zeros(1, 3, 224, 224))  # touch every weight page once
+    ready.set()
+    stop.wait()
+
+
+def measure(mode: str, workers: int) -> dict:
+    ctx = mp.get_context("spawn")  # like uvicorn --workers: no shared parent heap
+    stop = ctx.Event()
+    procs, events = [], []
+    for _ in range(workers):
+        ready = ctx.Event()
+        p = ctx.Process(target=_worker, args=(mode, ready, stop))
+        p.start()
+        procs.append(p)
+        events.append(ready)
+    for e in events:
+        e.wait(timeout=300)
+    mems = [_read_mem_kb(p.pid) for p in procs]
+    stop.set()
+    for p in procs:
+        p.join()
+    return {
+        "mode": mode,
+        "workers": workers,
+        "total_rss_mb": sum(m["rss"] for m in mems) / 1024,
+        "total_pss_mb": sum(m["pss"] for m in mems) / 1024,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4)
+    args = ap.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # make sure the mmap checkpoint exists before workers race for it
+    from local_model_fixed import get_model
+
+    get_model()
+    for mode in ("copy", "mmap"):
+        r = measure(mode, args.workers)
+        print(f"{r['mode']:>5}  workers={r['workers']}  total RSS={r['total_rss_mb']:.1f} MB  total PSS={r['total_pss_mb']:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import json_codec
+
+# Node-wide result cache shared by all uvicorn workers.
+# SQLite in WAL mode lets readers in every worker proceed while one writer
+# commits, so a result computed by one worker is a hit for the others.
+
+_local = threading.local()
+_counters = {"hits": 0, "misses": 0}  # per worker process
+_last_prune = 0.0
+_DEFAULT_PATH = os.path.join(os.path.dirname(__file__), ".cache", "results.sqlite3")
+
+
+def _db_path() -> str:
+    return os.getenv("RESULT_CACHE_PATH", _DEFAULT_PATH)
+
+
+def _connect() -> sqlite3.Connection:
+    # one connection per thread; sqlite3 connections are not shareable across threads
+    path = _db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == path:
+        return conn
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        " key TEXT PRIMARY KEY,"
+        " value TEXT NOT NULL,"
+        " created_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def enabled() -> bool:
+    return os.getenv("USE_RESULT_CACHE", "0") == "1"
+
+
+def make_key(image_bytes: bytes, *parts: str) -> str:
+    """Cache key from the image content plus whatever changes the answer (mode, model, language)."""
+    h = hashlib.sha256(image_bytes)
+    for p in parts:
+        h.update(b"\0" + str(p or "").encode("utf-8"))
+    return h.hexdigest()
+
+
+def _ttl() -> float:
+    return float(os.getenv("RESULT_CACHE_TTL_S", "86400"))
+
+
+def prune(conn: sqlite3.Connection | None = None) -> None:
+    """Delete expired rows and keep at most RESULT_CACHE_MAX_ENTRIES (newest first)."""
+    conn = conn or _connect()
+    max_entries = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+    conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - _ttl(),))
+    conn.execute(
+        "DELETE FROM results WHERE key IN ("
+        " SELECT key FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (max_entries,),
+    )
+
+
+def get(key: str):
+    ttl = _ttl()
+    try:
+        row = _connect().execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        _counters["misses"] += 1
+        return None
+    if row is None or time.time() - row[1] > ttl:
+        _counters["misses"] += 1
+        return None
+    try:
+        value = json_codec.loads(row[0])
+    except Exception:
+        _counters["misses"] += 1
+        return None
+    _counters["hits"] += 1
+    return value
+
+
+def put(key: str, value) -> None:
+    global _last_prune
+    try:
+        data = json_codec.dumps(value).decode("utf-8")
+        conn = _connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+            (key, data, now),
+        )
+        # periodic housekeeping on the write path (each worker at most once per interval)
+        if now - _last_prune >= float(os.getenv("RESULT_CACHE_PRUNE_INTERVAL_S", "60")):
+            _last_prune = now
+            prune(conn)
+    except (sqlite3.Error, TypeError, ValueError):
+        # cache is best effort; never fail a request because of it
+        pass
+
+
+def stats() -> dict:
+    try:
+        count = _connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    except sqlite3.Error as e:
+        return {"path": _db_path(), "error": str(e)}
+    return {"path": _db_path(), "entries": count, "worker_pid": os.getpid(), **_counters}
@@ -0,0 +1,147 @@
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("requests")  # chat_client's HTTP dependency
+
+import chat_client as cc  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def routing(monkeypatch):
+    """Fresh breaker / hedge state and a stubbed upstream for every test."""
+    monkeypatch.setattr(cc, "_breaker", {
+        "state": cc._BREAKER_CLOSED, "consecutive_failures": 0, "opened_at": 0.0, "probe_in_flight": False,
+    })
+    monkeypatch.setattr(cc, "_routing_stats", {
+        "requests": 0, "hedged": 0, "fallback_on_error": 0, "hedge_over_budget": 0,
+        "wins": {}, "local_routed": 0, "breaker_transitions": [],
+    })
+    monkeypatch.setattr(cc, "_primary_latencies", type(cc._primary_latencies)(maxlen=200))
+    monkeypatch.setattr(cc, "_hedge_history", type(cc._hedge_history)(maxlen=200))
+    monkeypatch.setattr(cc, "_local_fallback", lambda b64, reason: {"label": "local", "routing_reason": reason})
+    monkeypatch.setenv("CHAT_MODEL", "primary-model")
+    monkeypatch.setenv("CHAT_MODEL_FALLBACK", "fallback-model")
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+    monkeypatch.setenv("CIRCUIT_COOLDOWN_S", "0")
+    release = threading.Event()
+    yield release
+    release.set()  # unblock slow stubs left running in the pool
+
+
+def _stub(monkeypatch, behaviour):
+    """behaviour: model -> callable() returning a result or raising."""
+    calls = []
+
+    def classify(b64_image, model=None, timeout=None, **kwargs):
+        calls.append(model)
+        return behaviour[model]()
+
+    monkeypatch.setattr(cc, "classify_image_base64", classify)
+    return calls
+
+
+def _fail():
+    raise RuntimeError("upstream down")
+
+
+def _open_breaker(monkeypatch):
+    _stub(monkeypatch, {"primary-model": _fail, "fallback-model": _fail})
+    with pytest.raises(RuntimeError):
+        cc.classify_image_base64_hedged("x")
+    # the failure that opens the breaker is already answered locally
+    assert cc.classify_image_base64_hedged("x")["label"] == "local"
+    assert cc._breaker["state"] == cc._BREAKER_OPEN
+
+
+def test_breaker_opens_after_threshold_and_routes_local(monkeypatch):
+    monkeypatch.setenv("CIRCUIT_COOLDOWN_S", "60")
+    _open_breaker(monkeypatch)
+    res = cc.classify_image_base64_hedged("x")
+    assert res["label"] == "local"
+    assert res["routing_reason"] == "circuit breaker open"
+    assert cc.get_routing_stats()["local_routed"] == 2
+
+
+def test_half_open_admits_a_single_probe():
+    cc._breaker.update(state=cc._BREAKER_OPEN, opened_at=time.monotonic())
+    assert cc._breaker_admit() == "probe"
+    assert cc._breaker["state"] == cc._BREAKER_HALF_OPEN
+    assert cc._breaker_admit() == "local"
+    assert cc._breaker_admit() == "local"
+
+
+def test_only_probe_result_closes_breaker():
+    cc._breaker.update(state=cc._BREAKER_OPEN, opened_at=time.monotonic(), consecutive_failures=3)
+    cc._breaker_record(True, 0.1, probe=False)  # late success of a pre-open request
+    assert cc._breaker["state"] == cc._BREAKER_OPEN
+    assert cc._breaker["consecutive_failures"] == 0
+    assert cc._breaker_admit() == "probe"
+    cc._breaker_record(True, 0.1, probe=True)
+    assert cc._breaker["state"] == cc._BREAKER_CLOSED
+
+
+def test_failed_probe_reopens_breaker():
+    cc._breaker.update(state=cc._BREAKER_OPEN, opened_at=0.0)
+    assert cc._breaker_admit() == "probe"
+    cc._breaker_record(False, 0.1, probe=True)
+    assert cc._breaker["state"] == cc._BREAKER_OPEN
+    assert not cc._breaker["probe_in_flight"]
+
+
+def test_latency_spike_counts_as_failure(monkeypatch):
+    monkeypatch.setenv("CIRCUIT_LATENCY_SPIKE_S", "1")
+    cc._breaker_record(True, 5.0, probe=False)
+    cc._breaker_record(True, 5.0, probe=False)
+    assert cc._breaker["state"] == cc._BREAKER_OPEN
+
+
+def test_early_primary_failure_goes_to_fallback(monkeypatch):
+    monkeypatch.setenv("HEDGE_DELAY_DEFAULT_S", "5")
+    calls = _stub(monkeypatch, {"primary-model": _fail, "fallback-model": lambda: {"label": "pizza"}})
+    started = time.monotonic()
+    res = cc.classify_image_base64_hedged("x")
+    assert time.monotonic() - started < 2  # did not wait out the hedge delay
+    assert res["routed_to"] == "fallback-model"
+    assert calls == ["primary-model", "fallback-model"]
+    stats = cc.get_routing_stats()
+    assert stats["fallback_on_error"] == 1 and stats["hedged"] == 0
+
+
+def test_slow_primary_is_hedged(monkeypatch, routing):
+    monkeypatch.setenv("HEDGE_DELAY_DEFAULT_S", "0.05")
+    _stub(monkeypatch, {
+        "primary-model": lambda: routing.wait(5) and {"label": "late"},
+        "fallback-model": lambda: {"label": "pizza"},
+    })
+    res = cc.classify_image_base64_hedged("x")
+    assert res["routed_to"] == "fallback-model"
+    assert cc.get_routing_stats()["hedged"] == 1
+
+
+def test_hedge_budget_caps_hedge_rate(monkeypatch, routing):
+    monkeypatch.setenv("HEDGE_DELAY_DEFAULT_S", "0.05")
+    monkeypatch.setenv("HEDGE_MAX_RATIO", "0.25")
+    slow = threading.Event()
+    _stub(monkeypatch, {
+        "primary-model": lambda: slow.wait(0.2) or {"label": "rice"},
+        "fallback-model": lambda: routing.wait(5) and {"label": "late"},
+    })
+    for _ in range(8):
+        assert cc.classify_image_base64_hedged("x")["routed_to"] == "primary-model"
+    stats = cc.get_routing_stats()
+    # every primary was slow, but only 1 in 4 may be hedged
+    assert stats["hedged"] == 2
+    assert stats["hedge_budget"]["over_budget"] == 6
+    assert stats["hedge_budget"]["recent_ratio"] == 0.25
+
+
+def test_hedge_delay_uses_percentile_after_min_samples(monkeypatch):
+    monkeypatch.setenv("HEDGE_DELAY_DEFAULT_S", "8")
+    monkeypatch.setenv("HEDGE_MIN_SAMPLES", "20")
+    monkeypatch.setenv("HEDGE_PERCENTILE", "95")
+    cc._primary_latencies.extend(float(i) for i in range(1, 11))
+    assert cc._hedge_delay() == 8.0  # too few samples
+    cc._primary_latencies.extend(float(i) for i in range(11, 101))
+    assert cc._hedge_delay() == 95.0
@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from food_index import FoodIndex
+
+
+def _index():
+    # 4 labels x 2 reference rows on orthogonal axes
+    dim = 4
+    rows = []
+    for label in range(dim):
+        for jitter in (0.0, 0.1):
+            v = np.full(dim, jitter, dtype=np.float32)
+            v[label] = 1.0
+            rows.append(v / np.linalg.norm(v))
+    emb = np.stack(rows)
+    centroids = np.stack([emb[i * 2:i * 2 + 2].mean(axis=0) for i in range(dim)])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    return FoodIndex(emb, centroids, ["kimchi", "pizza", "sushi", "taco"], [0, 2, 4, 6])
+
+
+def test_exact_search_orders_labels():
+    q = np.array([0.9, 0.4, 0.1, 0.0], dtype=np.float32)
+    res = _index().search(q / np.linalg.norm(q), k=3)[0]
+    assert [c["label"] for c in res] == ["kimchi", "pizza", "sushi"]
+
+
+@pytest.mark.parametrize("probe", [1, 2, 3])
+def test_probe_returns_k_candidates(probe):
+    idx = _index()
+    q = np.array([0.9, 0.4, 0.1, 0.0], dtype=np.float32)
+    q /= np.linalg.norm(q)
+    exact = idx.search(q, k=3)[0]
+    approx = idx.search(q, k=3, probe=probe)[0]
+    assert len(approx) == 3
+    assert [c["label"] for c in approx] == [c["label"] for c in exact]
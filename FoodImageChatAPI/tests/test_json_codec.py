@@ -0,0 +1,43 @@
+import math
+
+import pytest
+
+import json_codec
+
+
+def _valid(**overrides):
+    obj = {"label": "pizza", "confidence": 0.9, "calories_kcal": 285, "serving": "1 slice", "notes": ""}
+    obj.update(overrides)
+    return obj
+
+
+def test_extract_from_fenced_prose():
+    text = 'Result:\n```json\n{"label": "pizza", "notes": "{cheese}"}\n```'
+    assert json_codec.extract_json_object(text) == {"label": "pizza", "notes": "{cheese}"}
+
+
+def test_numeric_string_is_coerced():
+    res = json_codec.parse_result(_valid(calories_kcal="560 kcal"))
+    assert res["calories_kcal"] == 560.0 and "schema_errors" not in res
+
+
+@pytest.mark.parametrize("value", [True, "about five hundred", [500]])
+def test_uncoercible_number_is_dropped(value):
+    res = json_codec.parse_result(_valid(calories_kcal=value))
+    assert res["calories_kcal"] is None
+    assert res["schema_errors"] == ["'calories_kcal' is not a number"]
+
+
+def test_non_finite_number_is_dropped():
+    res = json_codec.parse_result('{"label": "pizza", "confidence": NaN, "calories_kcal": Infinity,'
+                                  ' "serving": "1", "notes": ""}')
+    assert res["confidence"] is None and res["calories_kcal"] is None
+    assert len(res["schema_errors"]) == 2
+
+
+def test_dumps_never_emits_nan():
+    if json_codec.orjson is not None:
+        assert json_codec.dumps({"x": math.nan}) == b'{"x":null}'
+    else:
+        with pytest.raises(ValueError):
+            json_codec.dumps({"x": math.nan})
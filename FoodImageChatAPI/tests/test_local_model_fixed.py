@@ -0,0 +1,115 @@
+from local_model_fixed import region_proposals, merge_detections, summarize_detections, _calories
+from food_index import BACKGROUND_LABEL
+
+
+def _det(box, label="fried rice", confidence=0.9, margin=0.2):
+    return {"label": label, "confidence": confidence, "margin": margin, "alternatives": [], "box": list(box)}
+
+
+def _summarize(detections):
+    return summarize_detections(detections, min_score=0.5, ambiguous_below=0.65, min_margin=0.03)
+
+
+def test_grid_of_one_food_counts_calories_once():
+    boxes = region_proposals(900, 900, (3,))
+    assert len(boxes) == 25
+    res = _summarize([_det(b) for b in boxes])
+    assert len(res["items"]) == 1
+    assert res["items"][0]["extent"] == [0, 0, 900, 900]
+    assert res["items"][0]["box"] in [list(b) for b in boxes]  # crop stays one window
+    assert res["total_calories_kcal"] == _calories()["fried rice"]["calories_kcal"]
+
+
+def test_edge_window_not_duplicated():
+    xs = sorted({b[0] for b in region_proposals(1000, 1000, (2,))})
+    assert xs == [0, 250, 500]
+    xs = sorted({b[0] for b in region_proposals(1000, 1000, (3,))})
+    assert xs[-1] == 1000 - 333
+    assert all(b - a >= 333 // 2 for a, b in zip(xs, xs[1:]))
+
+
+def test_edge_window_added_when_gap_is_large():
+    xs = sorted({b[0] for b in region_proposals(1400, 1000, (2,))})
+    assert xs == [0, 250, 500, 750, 900]
+
+
+def test_single_window_keeps_start_edge():
+    assert region_proposals(1100, 1000, (1,)) == [(0, 0, 1000, 1000), (100, 0, 1100, 1000)]
+
+
+def _plate_detections(width, height, dishes):
+    """Label every proposal window with the dish covering most of it (background otherwise)."""
+    detections = []
+    for box in region_proposals(width, height):
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        cover = {
+            label: max(0, min(box[2], d[2]) - max(box[0], d[0])) * max(0, min(box[3], d[3]) - max(box[1], d[1])) / area
+            for label, d in dishes.items()
+        }
+        label = max(cover, key=cover.get)
+        if cover[label] < 0.2:
+            label = BACKGROUND_LABEL
+        detections.append(_det(box, label=label, confidence=0.5 + 0.5 * cover.get(label, 0.0)))
+    return detections
+
+
+def test_plate_with_three_dishes_gives_one_tight_box_per_dish():
+    dishes = {
+        "kimchi": (50, 50, 450, 450),
+        "pizza": (750, 50, 1150, 450),
+        "fried rice": (400, 500, 800, 880),
+    }
+    res = _summarize(_plate_detections(1200, 900, dishes))
+    assert sorted(i["label"] for i in res["items"]) == sorted(dishes)
+    table = _calories()
+    assert res["total_calories_kcal"] == sum(table[label]["calories_kcal"] for label in dishes)
+    for item in res["items"]:
+        box, dish = item["box"], dishes[item["label"]]
+        # escalation crop is a single window centred on its own dish
+        assert (box[2] - box[0]) * (box[3] - box[1]) <= 450 * 450
+        cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+        assert dish[0] <= cx <= dish[2] and dish[1] <= cy <= dish[3]
+
+
+def test_corner_touching_portions_of_same_food_stay_separate():
+    # two servings of kimchi in diagonal windows, nothing in between
+    merged = merge_detections([_det((0, 0, 300, 300), label="kimchi"), _det((150, 150, 450, 450), label="kimchi")])
+    assert len(merged) == 2
+
+
+def test_side_by_side_windows_merge():
+    merged = merge_detections([_det((0, 0, 300, 300)), _det((150, 0, 450, 300), confidence=0.95)])
+    assert len(merged) == 1
+    assert merged[0]["box"] == [150, 0, 450, 300]
+    assert merged[0]["extent"] == [0, 0, 450, 300]
+
+
+def test_weaker_other_label_on_same_region_dropped():
+    merged = merge_detections([_det((0, 0, 100, 100)), _det((5, 5, 100, 100), label="kimchi", confidence=0.7)])
+    assert [d["label"] for d in merged] == ["fried rice"]
+
+
+def test_background_and_low_scores_rejected():
+    res = _summarize([
+        _det((0, 0, 100, 100), label=BACKGROUND_LABEL, confidence=0.95),
+        _det((200, 0, 300, 100), label="kimchi", confidence=0.3),
+        _det((400, 0, 500, 100), label="fried rice", confidence=0.8),
+    ])
+    assert [i["label"] for i in res["items"]] == ["fried rice"]
+    assert res["rejected"] == 2
+
+
+def test_no_confident_region_reports_ambiguous_without_calories():
+    res = _summarize([
+        _det((0, 0, 100, 100), label=BACKGROUND_LABEL, confidence=0.95),
+        _det((200, 0, 300, 100), label="kimchi", confidence=0.3),
+    ])
+    assert len(res["items"]) == 1
+    item = res["items"][0]
+    assert item["label"] == "kimchi" and item["ambiguous"] and item["calories_kcal"] is None
+    assert res["total_calories_kcal"] == 0
+
+
+def test_only_background_gives_no_items():
+    res = _summarize([_det((0, 0, 100, 100), label=BACKGROUND_LABEL)])
+    assert res["items"] == [] and res["total_calories_kcal"] == 0